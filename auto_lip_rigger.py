@@ -1,51 +1,96 @@
+import contextlib
+import re
 import pymel.core as pm
-from pymel.core.datatypes import Vector
+import maya.cmds as cmds
+import maya.api.OpenMaya as om2
 from PySide2 import QtCore, QtWidgets
 from shiboken2 import wrapInstance
 import maya.OpenMayaUI as omui
 
+_JNT_RE = re.compile(r"^(.*)_jnt")
+_SIDE_RE = re.compile(r"_[LR]_")
+_MAIN_RE = re.compile(r"_[LRUD]_")
+
+
+def get_dag_path(node):
+
+    selection = om2.MSelectionList()
+    selection.add(str(node))
+
+    return selection.getDagPath(0)
+
+@contextlib.contextmanager
+def rig_build_mode(chunk_name: str="auto_lip_rigger"):
+
+    with contextlib.ExitStack() as restore:
+        restore.callback(cmds.refresh, force=True)
+
+        cmds.undoInfo(openChunk=True, chunkName=chunk_name)
+        restore.callback(cmds.undoInfo, closeChunk=True)
+
+        evaluation_mode = cmds.evaluationManager(query=True, mode=True)[0]
+        restore.callback(cmds.evaluationManager, mode=evaluation_mode)
+        cmds.evaluationManager(mode="off")
+
+        cycle_check = cmds.cycleCheck(query=True, evaluation=True)
+        restore.callback(cmds.cycleCheck, evaluation=cycle_check)
+        cmds.cycleCheck(evaluation=False)
+
+        restore.callback(cmds.refresh, suspend=False)
+        cmds.refresh(suspend=True)
+
+        yield
 
 def get_edge_curve(selectedEdge, prefix: str="", numCurve: int=0):
 
-    pm.select(selectedEdge, replace=True)
-    curve = pm.polyToCurve(constructionHistory=0, form=2, degree=3, conformToSmoothMeshPreview=0, name = f"{prefix}_00{numCurve}_crv" )
-    curve = pm.rebuildCurve(curve, constructionHistory=0, replaceOriginal=1, rebuildType=0, endKnots=1, keepRange=0, keepControlPoints=1, keepEndPoints=1, keepTangents=0, degree=3)[0]
-    pm.select(clear=True)
+    curve = cmds.polyToCurve(selectedEdge, constructionHistory=0, form=2, degree=3, conformToSmoothMeshPreview=0, name = f"{prefix}_00{numCurve}_crv" )[0]
+    curve = cmds.rebuildCurve(curve, constructionHistory=0, replaceOriginal=1, rebuildType=0, endKnots=1, keepRange=0, keepControlPoints=1, keepEndPoints=1, keepTangents=0, degree=3)[0]
 
     return curve
 
 def get_edge_count(selectedEdge):
 
-    pm.select(selectedEdge, replace = True)
-    edge_count = pm.polyEvaluate(edgeComponent=True)
-    pm.select(clear=True)
+    selection = om2.MSelectionList()
+    for edge in selectedEdge:
+        selection.add(str(edge))
+
+    edge_count = 0
+    for i in range(selection.length()):
+        dag_path, component = selection.getComponent(i)
+        edge_iter = om2.MItMeshEdge(dag_path, component)
+        while not edge_iter.isDone():
+            edge_count += 1
+            edge_iter.next()
 
     return edge_count
 
 
 def move_Seam(vertex_position, crv):
 
-    nearest_point_node = pm.createNode("nearestPointOnCurve")
-    nearest_point_node.inPosition.set(vertex_position)
-    crv.getShape().attr("worldSpace[0]") >> nearest_point_node.inputCurve
-    pm.select(crv.u[nearest_point_node.parameter.get()], replace=True)
-    pm.mel.eval("MoveCurveSeam;")
-    pm.delete(nearest_point_node)
-    pm.select(clear = True)
+    crv_dag = get_dag_path(crv).extendToShape()
+    crv_fn = om2.MFnNurbsCurve(crv_dag)
+    if crv_fn.form != om2.MFnNurbsCurve.kPeriodic:
+        return crv
+
+    u_value = crv_fn.closestPoint(om2.MPoint(*vertex_position), space=om2.MSpace.kWorld)[1]
+    start, end = crv_fn.knotDomain
+    spans = crv_fn.numSpans
+    seam_span = int(round((u_value - start) / (end - start) * spans)) % spans
+
+    points = list(crv_fn.cvPositions(om2.MSpace.kObject))[:spans]
+    points = points[seam_span:] + points[:seam_span]
+    crv_shape = crv_dag.fullPathName()
+    for i, point in enumerate(points + points[:crv_fn.degree]):
+        cmds.xform(f"{crv_shape}.cv[{i}]", translation=(point.x, point.y, point.z), objectSpace=True)
 
     return crv
 
-def get_reference_size(crv_1, crv_2):
-    
-    size_node = pm.createNode("pointOnCurveInfo")
-    crv_1.getShape().attr("worldSpace[0]") >> size_node.inputCurve
-    crv_1_vector = Vector(size_node.position.get())
-    crv_2.getShape().attr("worldSpace[0]") >> size_node.inputCurve
-    crv_2_vector = Vector(size_node.position.get())
+def get_reference_size(crv_1_fn, crv_2_fn):
 
-    size = crv_1_vector.distanceTo(crv_2_vector)
+    crv_1_point = crv_1_fn.getPointAtParam(0.0, om2.MSpace.kWorld)
+    crv_2_point = crv_2_fn.getPointAtParam(0.0, om2.MSpace.kWorld)
 
-    pm.delete(size_node)
+    size = (crv_1_point - crv_2_point).length()
 
     return size
 
@@ -62,132 +107,137 @@ def get_lofted_surface(crvSeam_1, crvSeam_2, vertex, prefix: str=""):
     
     pm.delete(lofted_surface, ch=True)
    
-    point_info = pm.createNode("pointOnSurfaceInfo")
-    lofted_surface.getShape().attr("worldSpace[0]") >> point_info.inputSurface
-    dot = Vector.dot([0,0,1],point_info.result.normal.get())
+    surface_fn = om2.MFnNurbsSurface(get_dag_path(lofted_surface.getShape()))
+    normal = surface_fn.normal(0.0, 0.0, om2.MSpace.kWorld)
 
-    if dot < 0 :
+    if normal.z < 0 :
         pm.reverseSurface(lofted_surface)
-    
-    pm.delete(point_info)
 
     return lofted_surface
 
-def create_surface_ribbons(lofted_surface, prefix, follicle_grp, binding_joint_grp, u_count, size):
+def create_surface_ribbons(surface_matrix_plug, surface_plug, prefix, follicle_grp, binding_joint_grp, u_count, size):
 
+    follicles = []
     for i in range(u_count):
+        fol_rbn = cmds.createNode('transform', name=f"{prefix}_rbn_{i+1}_fol", parent=follicle_grp, skipSelect=True)
+        folShape_rbn = cmds.createNode('follicle', name=fol_rbn+'Shape', parent=fol_rbn, skipSelect=True)
+        follicles.append((fol_rbn, folShape_rbn))
 
-        fol_rbn = pm.createNode('transform', name=f"{prefix}_rbn_{i+1}_fol", skipSelect=True)
-        folShape_rbn = pm.createNode('follicle' , name=fol_rbn.name()+'Shape', parent=fol_rbn, skipSelect=True)
-        folShape_rbn.outRotate >> fol_rbn.rotate
-        folShape_rbn.outTranslate >> fol_rbn.translate
-        lofted_surface.worldMatrix >> fol_rbn.inputWorldMatrix
-        lofted_surface.local >> fol_rbn.inputSurface
+    for fol_rbn, folShape_rbn in follicles:
+        cmds.connectAttr(f"{folShape_rbn}.outRotate", f"{fol_rbn}.rotate")
+        cmds.connectAttr(f"{folShape_rbn}.outTranslate", f"{fol_rbn}.translate")
+        cmds.connectAttr(surface_matrix_plug, f"{folShape_rbn}.inputWorldMatrix")
+        cmds.connectAttr(surface_plug, f"{folShape_rbn}.inputSurface")
 
-        folShape_rbn.parameterU.set(0+(1.0/u_count) * i)
-        folShape_rbn.parameterV.set(0.5)
+    u_parameters = [i / u_count for i in range(u_count)]
+    for (fol_rbn, folShape_rbn), u_parameter in zip(follicles, u_parameters):
+        cmds.setAttr(f"{folShape_rbn}.parameterU", u_parameter)
+        cmds.setAttr(f"{folShape_rbn}.parameterV", 0.5)
 
-        rbn_joint = pm.joint(radius = size/3, name =f"{prefix}_{i+1}_bnd_jnt")
-         
-        pm.parent(rbn_joint , binding_joint_grp)
-        pm.parent(fol_rbn, follicle_grp)
+    for i, (fol_rbn, folShape_rbn) in enumerate(follicles):
 
-        pm.parentConstraint(fol_rbn , rbn_joint , skipRotate=['x','y','z'], maintainOffset = 0 , weight=1)
-        pm.orientConstraint(fol_rbn , rbn_joint , maintainOffset = 0)
-        pm.select(clear=1)
+        rbn_joint = cmds.createNode('joint', name=f"{prefix}_{i+1}_bnd_jnt", parent=binding_joint_grp, skipSelect=True)
+        cmds.setAttr(f"{rbn_joint}.radius", size/3)
 
-def get_corner_point(valueX, valueY, valueZ , lofted_surface):
+        cmds.parentConstraint(fol_rbn , rbn_joint , maintainOffset = False , weight=1)
 
-    nearest_point_node = pm.createNode('closestPointOnSurface')
-    lofted_surface.getShape().attr("worldSpace[0]") >> nearest_point_node.inputSurface
-    nearest_point_node.inPositionX.set(valueX)
-    nearest_point_node.inPositionY.set(valueY)
-    nearest_point_node.inPositionZ.set(valueZ)
-    u_value = nearest_point_node.parameterU.get()
+def get_corner_point(point, surface_fn):
 
-    pm.delete(nearest_point_node)
+    u_value = surface_fn.closestPoint(point, space=om2.MSpace.kWorld)[1]
 
     return u_value
 
-def set_control_joints( u_value , v_value , lofted_surface , prefix , size ):
+def create_query_follicle(surface_matrix_plug, surface_plug, parent):
 
-    fol = pm.createNode('transform' , name ='follicleCorner', skipSelect=True)
-    folShape = pm.createNode('follicle' , name =fol.name()+'Shape' , parent=fol, skipSelect=True)
-    folShape.outRotate >> fol.rotate
-    folShape.outTranslate >> fol.translate
-    lofted_surface.worldMatrix >> fol.inputWorldMatrix
-    lofted_surface.local >> fol.inputSurface
+    fol = cmds.createNode('transform' , name ='follicleCorner', parent=parent, skipSelect=True)
+    folShape = cmds.createNode('follicle' , name =fol+'Shape' , parent=fol, skipSelect=True)
+    cmds.connectAttr(surface_matrix_plug, f"{folShape}.inputWorldMatrix")
+    cmds.connectAttr(surface_plug, f"{folShape}.inputSurface")
 
-    folShape.parameterU.set(u_value)
-    folShape.parameterV.set(v_value)
-    
-    temp_joint = pm.joint(position = fol.translate.get() , orientation = fol.rotate.get(), name = f"{prefix}_ctrl_jnt", radius = size/2)
+    return fol
+
+def place_control_joint(joint, u_value, v_value, folShape):
+
+    cmds.setAttr(f"{folShape}.parameterU", u_value)
+    cmds.setAttr(f"{folShape}.parameterV", v_value)
+
+    cmds.setAttr(f"{joint}.translate", *cmds.getAttr(f"{folShape}.outTranslate")[0])
+    cmds.setAttr(f"{joint}.jointOrient", *cmds.getAttr(f"{folShape}.outRotate")[0])
 
-    pm.delete(fol)
-    pm.select(clear = True)
+def set_control_joints( u_value , v_value , folShape , prefix , size, parent=None ):
+
+    if parent:
+        temp_joint = cmds.createNode('joint', name = f"{prefix}_ctrl_jnt", parent=parent, skipSelect=True)
+    else:
+        temp_joint = cmds.createNode('joint', name = f"{prefix}_ctrl_jnt", skipSelect=True)
+    place_control_joint(temp_joint, u_value, v_value, folShape)
+    cmds.setAttr(f"{temp_joint}.radius", size/2)
 
     return temp_joint
 
 def create_controller(joint, main_controller_grp , size):
 
-    jointName = joint.name()
-    positionString = jointName.index("_jnt")
-    controller_prefix = jointName[0:positionString]
+    jointName = str(joint)
+    controller_prefix = _JNT_RE.match(jointName).group(1)
+    is_side = bool(_SIDE_RE.search(jointName))
+    is_main = bool(_MAIN_RE.search(jointName))
 
-    ctrl_grp = pm.group(name = f"{controller_prefix}_grp", empty = True )
-    ctrl_buffer_grp = pm.group(name =f"{controller_prefix}_buffer_grp", empty = True)
-    pm.parent(ctrl_buffer_grp, ctrl_grp)
+    ctrl_grp = cmds.group(name = f"{controller_prefix}_grp", empty = True )
+    ctrl_buffer_grp = cmds.group(name =f"{controller_prefix}_buffer_grp", empty = True, parent = ctrl_grp)
 
-    controller = pm.circle(name = controller_prefix , radius = size/4)
-    pm.parent(controller[0], ctrl_buffer_grp)
+    controller = cmds.circle(name = controller_prefix , radius = size/4, constructionHistory = False)[0]
+    controller = cmds.parent(controller, ctrl_buffer_grp)[0]
 
-    ctrl_grp.translate.set(joint.translate.get())
+    cmds.setAttr(f"{ctrl_grp}.translate", *cmds.getAttr(f"{jointName}.translate")[0])
 
-    if jointName.find("_L_") == -1 and jointName.find("_R_") == -1 :
-        ctrl_grp.rotate.set(joint.jointOrient.get())
+    if not is_side:
+        cmds.setAttr(f"{ctrl_grp}.rotate", *cmds.getAttr(f"{jointName}.jointOrient")[0])
 
-    pm.parentConstraint(controller, joint , maintainOffset = 1)
-    pm.parent(ctrl_grp, main_controller_grp)
-    controller[0].sx.set(keyable=0, lock = 1)
-    controller[0].sy.set(keyable=0, lock = 1)
-    controller[0].sz.set(keyable=0, lock = 1)
-    controller[0].v.set(keyable=0, lock = 1)
-    controller[0].getShape().overrideEnabled.set(True)
+    cmds.parentConstraint(controller, jointName , maintainOffset = True)
+    cmds.parent(ctrl_grp, main_controller_grp)
+    controller_shape = cmds.listRelatives(controller, shapes=True, fullPath=True)[0]
+    for attr in ("sx", "sy", "sz", "v"):
+        cmds.setAttr(f"{controller}.{attr}", keyable=False, lock=True)
+    cmds.setAttr(f"{controller_shape}.overrideEnabled", True)
+    cmds.setAttr(f"{controller_shape}.overrideColor", 17 if is_main else 13)
 
-    if (jointName.find("_D_")  != -1 or jointName.find("_L_")  != -1 or jointName.find("_U_")  != -1 or jointName.find("_R_")  != -1):
-        controller[0].getShape().overrideColor.set(17)
-    else:
-        controller[0].getShape().overrideColor.set(13)
+    cmds.move(0 , 0 , size/4, f"{controller}.cv[*]", relative = True,
+              worldSpace = True, worldSpaceDistance = True)
 
-    points = pm.select(f"{controller[0]}.cv[0:7]")
-    pm.move(0 , 0 , size/4, points, relative = True, 
-                worldSpace = True, worldSpaceDistance = True)
+    return controller
 
 
-def create_blend_for_segment_controller(prefix):
+def create_blend_for_segment_controller(controllers_by_segment):
 
-    controller_left= pm.ls(f"{prefix}_L_ctrl")
-    controller_right= pm.ls(f"{prefix}_R_ctrl")
-    controller_middle_up= pm.ls(f"{prefix}_U_ctrl")
-    controller_middle_down= pm.ls(f"{prefix}_D_ctrl")
+    controller_left= controllers_by_segment["L"]
+    controller_right= controllers_by_segment["R"]
+    controller_middle_up= controllers_by_segment["U"]
+    controller_middle_down= controllers_by_segment["D"]
 
-    create_blend(controller_left, controller_middle_up, f"{prefix}_LU_")
-    create_blend(controller_left, controller_middle_down, f"{prefix}_LD_")
-    create_blend(controller_right, controller_middle_up, f"{prefix}_RU_")
-    create_blend(controller_right, controller_middle_down, f"{prefix}_RD_")
+    create_blend(controller_left, controller_middle_up, controllers_by_segment.get("LU", []))
+    create_blend(controller_left, controller_middle_down, controllers_by_segment.get("LD", []))
+    create_blend(controller_right, controller_middle_up, controllers_by_segment.get("RU", []))
+    create_blend(controller_right, controller_middle_down, controllers_by_segment.get("RD", []))
 
 
-def create_blend(side, middle, contains):
+def create_blend(side, middle, controller_segment):
 
-    controller_segment =  pm.ls(f"{contains}*_ctrl")
-    length = len(controller_segment)
+    step = 1/(len(controller_segment)+1)
+    buffer_grps = [f"{controller}_buffer_grp" for controller in controller_segment]
 
-    for i in range (length):
-        value = (1/(length+1))*(i+1)
-        controller_temp = f"{controller_segment[i].name()}_buffer_grp"
-        pm.parentConstraint(side , controller_temp, maintainOffset = 1, weight=1-value)
-        pm.parentConstraint(middle , controller_temp , maintainOffset = 1, weight=value)
+    for i, controller_temp in enumerate(buffer_grps, 1):
+        value = step*i
+        cmds.parentConstraint(side , controller_temp, maintainOffset = True, weight=1-value)
+        cmds.parentConstraint(middle , controller_temp , maintainOffset = True, weight=value)
         
+def selection_label(components, limit=5):
+
+    label = ", ".join(components[:limit])
+    if len(components) > limit:
+        label += " ..."
+
+    return label
+
 def mayaWindow():
     main_window_ptr = omui.MQtUtil.mainWindow()
     return wrapInstance(int(main_window_ptr),QtWidgets.QWidget)
@@ -202,6 +252,12 @@ class ribbon_lip_rigger(QtWidgets.QDialog):
         self.second_edge_loop = 0
         self.vertex_on_edge = 0
         self.lofted_surface = 0
+        self.surface_dag = None
+        self.surface_fn = None
+        self.surface_matrix_plug = ""
+        self.surface_plug = ""
+        self.curve_1_fn = None
+        self.curve_2_fn = None
         self.v_value = 0.5
         self.prefix = ""
         self.uValue_right_corner = 0.75
@@ -212,10 +268,19 @@ class ribbon_lip_rigger(QtWidgets.QDialog):
         self.deformer_grp = 0 
         self.follicle_grp = 0
         self.binding_joint_grp = 0
-        self.control_joint_grp = 0  
+        self.control_joint_grp = ""
+        self._ctrl_grp_exists = False
         self.controller_grp = 0
+        self.query_follicle = 0
+        self.query_follicle_shape = 0
         self.size = 0
         self.direction_counter_clockwise = False
+        self._segment_directions = {"RU": 1, "RD": -1, "LU": -1, "LD": 1}
+        self._controllers_by_segment = {}
+        self._ctrl_joints = []
+        self._segment_joints = {"RU": [], "RD": [], "LU": [], "LD": []}
+        self._current_segment_count = 0
+        self._last_segment_value = None
         
 
         super(ribbon_lip_rigger,self).__init__(parent)
@@ -224,8 +289,34 @@ class ribbon_lip_rigger(QtWidgets.QDialog):
         self.setWindowFlags(QtCore.Qt.Window)
         self.setAttribute(QtCore.Qt.WA_DeleteOnClose, 1)
         self.resize(400, 250)
+
+        self._pending_segment_value = 0
+        self._segment_timer = QtCore.QTimer(self)
+        self._segment_timer.setSingleShot(True)
+        self._segment_timer.setInterval(150)
+        self._segment_timer.timeout.connect(self._do_segment_joints)
+
         self.layout()
     
+    def _row(self, title, readonly=True, button_text=None):
+
+        row_layout = QtWidgets.QHBoxLayout()
+        row_layout.setContentsMargins(1,1,1,1)
+        row_layout.addWidget(QtWidgets.QLabel(title, self))
+
+        line_edit = QtWidgets.QLineEdit(self)
+        if readonly:
+            line_edit.setReadOnly(True)
+            line_edit.deselect()
+        row_layout.addWidget(line_edit)
+
+        button = None
+        if button_text is not None:
+            button = QtWidgets.QPushButton(button_text, self)
+            row_layout.addWidget(button)
+
+        return row_layout, line_edit, button
+
     def layout(self):
 
         self.user_input_group = QtWidgets.QGroupBox("User Input")
@@ -240,46 +331,12 @@ class ribbon_lip_rigger(QtWidgets.QDialog):
         self.user_input_text_layout.addWidget(self.user_input_text_01)
         self.user_input_text_layout.addWidget(self.user_input_text_02)
  
-        self.prefix_layout = QtWidgets.QHBoxLayout()
-        self.prefix_layout.setContentsMargins(1, 1, 1, 1)
-        self.prefix_titel = QtWidgets.QLabel("Prefix:", self)
-        self.prefix_text = QtWidgets.QLineEdit(self)
+        self.prefix_layout, self.prefix_text, _ = self._row("Prefix:", readonly=False)
         self.prefix_text.setText("Lip")
-        self.prefix_layout.addWidget(self.prefix_titel)
-        self.prefix_layout.addWidget(self.prefix_text)
-
-        self.first_edge_loop_layout = QtWidgets.QHBoxLayout()
-        self.first_edge_loop_layout.setContentsMargins(1,1,1,1)
-        self.first_edge_loop_titel = QtWidgets.QLabel("First Edge Loop:", self)
-        self.first_edge_loop_text = QtWidgets.QLineEdit(self)
-        self.first_edge_loop_text.setReadOnly(True)
-        self.first_edge_loop_text.deselect()
-        self.first_edge_loop_button = QtWidgets.QPushButton("<<", self)
-        self.first_edge_loop_layout.addWidget(self.first_edge_loop_titel)
-        self.first_edge_loop_layout.addWidget(self.first_edge_loop_text)
-        self.first_edge_loop_layout.addWidget(self.first_edge_loop_button)
-
-        self.second_edge_loop_layout = QtWidgets.QHBoxLayout()
-        self.second_edge_loop_layout.setContentsMargins(1,1,1,1)
-        self.second_edge_loop_titel = QtWidgets.QLabel("Second Edge Loop:", self)
-        self.second_edge_loop_text = QtWidgets.QLineEdit(self)
-        self.second_edge_loop_text.setReadOnly(True)
-        self.second_edge_loop_text.deselect()
-        self.second_edge_loop_button = QtWidgets.QPushButton("<<", self)
-        self.second_edge_loop_layout.addWidget(self.second_edge_loop_titel)
-        self.second_edge_loop_layout.addWidget(self.second_edge_loop_text)
-        self.second_edge_loop_layout.addWidget(self.second_edge_loop_button)
-
-        self.vertex_layout = QtWidgets.QHBoxLayout()
-        self.vertex_layout.setContentsMargins(1,1,1,1)
-        self.vertex_titel = QtWidgets.QLabel("Vertex:", self)
-        self.vertex_text = QtWidgets.QLineEdit(self)
-        self.vertex_text.setReadOnly(True)
-        self.vertex_text.deselect()
-        self.vertex_button = QtWidgets.QPushButton("<<", self)
-        self.vertex_layout.addWidget(self.vertex_titel)
-        self.vertex_layout.addWidget(self.vertex_text)
-        self.vertex_layout.addWidget(self.vertex_button)
+
+        self.first_edge_loop_layout, self.first_edge_loop_text, self.first_edge_loop_button = self._row("First Edge Loop:", button_text="<<")
+        self.second_edge_loop_layout, self.second_edge_loop_text, self.second_edge_loop_button = self._row("Second Edge Loop:", button_text="<<")
+        self.vertex_layout, self.vertex_text, self.vertex_button = self._row("Vertex:", button_text="<<")
 
         self.user_input_button_layout = QtWidgets.QHBoxLayout()
         self.user_input_button_layout.setContentsMargins(1,1,1,1)
@@ -348,153 +405,245 @@ class ribbon_lip_rigger(QtWidgets.QDialog):
         self.second_edge_loop_button.clicked.connect(self.get_2nd_edge_loop)
         self.vertex_button.clicked.connect(self.get_vertex_on_edge_loop)
         self.user_input_button.clicked.connect(self.user_input)
-        self.inbetween_joints_slider.valueChanged.connect(self.segment_joints)
+        self.inbetween_joints_slider.valueChanged.connect(self._queue_segment_joints)
         self.finish_rig_button.clicked.connect(self.finish_rig)
 
     def user_input(self):
 
-        self.prefix = self.prefix_text.text()
-        first_edge_loop = self.first_edge_Loop
-        second_edge_loop = self.second_edge_Loop
-        vertex_on_edge = self.vertex_on_edge
+        with rig_build_mode("user_input"):
+            self.prefix = self.prefix_text.text()
+            first_edge_loop = self.first_edge_Loop
+            second_edge_loop = self.second_edge_Loop
+            vertex_on_edge = self.vertex_on_edge
 
-        self.deformer_grp = pm.group(name=f"{self.prefix}_deformer_grp", empty=True )
+            self.deformer_grp = cmds.group(name=f"{self.prefix}_deformer_grp", empty=True )
 
-        self.curve_1 = get_edge_curve(first_edge_loop, self.prefix, numCurve=1)
-        self.curve_2 = get_edge_curve(second_edge_loop, self.prefix, numCurve=2)
+            self.curve_1 = get_edge_curve(first_edge_loop, self.prefix, numCurve=1)
+            self.curve_2 = get_edge_curve(second_edge_loop, self.prefix, numCurve=2)
 
-        pm.parent(self.curve_1, self.deformer_grp)
-        pm.parent(self.curve_2, self.deformer_grp)
+            self.curve_1, self.curve_2 = cmds.parent(self.curve_1, self.curve_2, self.deformer_grp)
+            self.curve_1_fn = om2.MFnNurbsCurve(get_dag_path(self.curve_1).extendToShape())
+            self.curve_2_fn = om2.MFnNurbsCurve(get_dag_path(self.curve_2).extendToShape())
 
-        u_count = get_edge_count(first_edge_loop)
-        self.size = get_reference_size(self.curve_1, self.curve_2)
-        self.lofted_surface = get_lofted_surface(self.curve_1, self.curve_2, vertex_on_edge,self.prefix)
+            u_count = get_edge_count(first_edge_loop)
+            self.size = get_reference_size(self.curve_1_fn, self.curve_2_fn)
+            self.lofted_surface = get_lofted_surface(self.curve_1, self.curve_2, vertex_on_edge,self.prefix)
 
-        pm.parent(self.lofted_surface, self.deformer_grp)
+            cmds.parent(self.lofted_surface.name(), self.deformer_grp)
+            self.surface_dag = get_dag_path(self.lofted_surface.getShape())
+            self.surface_fn = om2.MFnNurbsSurface(self.surface_dag)
+            self.surface_matrix_plug = f"{self.lofted_surface.name()}.worldMatrix[0]"
+            self.surface_plug = f"{self.surface_dag.fullPathName()}.local"
 
-        self.follicle_grp = pm.group(name=f"{self.prefix}_follicle_grp", empty=True)
-        pm.parent(self.follicle_grp , self.deformer_grp)
-        self.binding_joint_grp = pm.group(name=f"{self.prefix}_binding_joints_grp" , empty=True )
+            self.follicle_grp = cmds.group(name=f"{self.prefix}_follicle_grp", empty=True, parent=self.deformer_grp)
+            self.binding_joint_grp = cmds.group(name=f"{self.prefix}_binding_joints_grp" , empty=True )
 
-        create_surface_ribbons(self.lofted_surface, self.prefix, self.follicle_grp, self.binding_joint_grp, u_count, self.size)
+            create_surface_ribbons(self.surface_matrix_plug, self.surface_plug, self.prefix, self.follicle_grp, self.binding_joint_grp, u_count, self.size)
 
-        self.deformer_grp.v.set(False)
-        self.binding_joint_grp.v.set(False)
+            cmds.setAttr(f"{self.deformer_grp}.visibility", False)
+            cmds.setAttr(f"{self.binding_joint_grp}.visibility", False)
 
-        bbx = pm.exactWorldBoundingBox(self.lofted_surface)
-        bbx_yAverage = (bbx[4]- bbx[1]) /2
-        bbx_yResult = bbx[1] + bbx_yAverage
+            bbx = cmds.exactWorldBoundingBox(self.lofted_surface.name())
+            bbx_yAverage = (bbx[4]- bbx[1]) /2
+            bbx_yResult = bbx[1] + bbx_yAverage
 
-        self.uValue_right_corner = get_corner_point(bbx[0] , bbx_yResult, bbx[2], self.lofted_surface)
-        self.uValue_left_corner = get_corner_point(bbx[3] , bbx_yResult, bbx[2], self.lofted_surface)
+            self.uValue_right_corner = get_corner_point(om2.MPoint(bbx[0], bbx_yResult, bbx[2]), self.surface_fn)
+            self.uValue_left_corner = get_corner_point(om2.MPoint(bbx[3], bbx_yResult, bbx[2]), self.surface_fn)
 
-        if self.uValue_right_corner < self.uValue_left_corner:
-            self.direction_counter_clockwise = True
-            self.uValue_right_corner = 0.25
-            self.uValue_left_corner = 0.75
+            if self.uValue_right_corner < self.uValue_left_corner:
+                self.direction_counter_clockwise = True
+                self.uValue_right_corner = 0.25
+                self.uValue_left_corner = 0.75
 
-        self.right_corner_joint = set_control_joints( self.uValue_right_corner, self.v_value , self.lofted_surface, f"{self.prefix}_R" , self.size)
-        self.left_corner_joint = set_control_joints( self.uValue_left_corner, self.v_value , self.lofted_surface, f"{self.prefix}_L" , self.size)
-        self.upper_corner_joint = set_control_joints( self.uValue_upper_corner, self.v_value , self.lofted_surface, f"{self.prefix}_U" , self.size)
-        self.lower_corner_joint = set_control_joints( self.uValue_lower_corner, self.v_value , self.lofted_surface, f"{self.prefix}_D" , self.size)
+            right_up = -1 if self.direction_counter_clockwise else 1
+            self._segment_directions = {"RU": right_up, "RD": -right_up, "LU": -right_up, "LD": right_up}
 
-    def segment_joints(self, value):
+            self.query_follicle = create_query_follicle(self.surface_matrix_plug, self.surface_plug, self.deformer_grp)
+            self.query_follicle_shape = cmds.listRelatives(self.query_follicle, shapes=True, fullPath=True)[0]
+
+            (self.right_corner_joint, self.left_corner_joint,
+             self.upper_corner_joint, self.lower_corner_joint) = self._make_control_joints([
+                (self.uValue_right_corner, self.v_value, f"{self.prefix}_R"),
+                (self.uValue_left_corner, self.v_value, f"{self.prefix}_L"),
+                (self.uValue_upper_corner, self.v_value, f"{self.prefix}_U"),
+                (self.uValue_lower_corner, self.v_value, f"{self.prefix}_D"),
+            ])
+            self._ctrl_joints = [self.right_corner_joint, self.left_corner_joint, self.upper_corner_joint, self.lower_corner_joint]
+
+            if self._ctrl_grp_exists and cmds.objExists(self.control_joint_grp):
+                cmds.delete(self.control_joint_grp)
+            self._ctrl_grp_exists = False
+            self._reset_segment_joints()
+
+            om2.MGlobal.setActiveSelectionList(om2.MSelectionList())
+
+    def _make_control_joints(self, joint_specs, parent=None):
+
+        folShape = self.query_follicle_shape
+        size = self.size
+
+        return [set_control_joints(u_value, v_value, folShape, name, size, parent=parent) for u_value, v_value, name in joint_specs]
+
+    def _queue_segment_joints(self, value):
 
-        slider_value = value
         self.inbetween_joints_text.setText(str(value))
+        self._pending_segment_value = value
+        self._segment_timer.start()
 
-        if pm.objExists(self.control_joint_grp) == True:
-            pm.delete(self.control_joint_grp)
+    def _do_segment_joints(self):
 
-        self.control_joint_grp = pm.group( name= f"{self.prefix}_control_ joints_grp", empty = True )
+        self.segment_joints(self._pending_segment_value)
 
-        for i in range (1,slider_value+1) :
+    def _reset_segment_joints(self):
 
-            if self.direction_counter_clockwise == True :
-                u_value_upper_right = (self.uValue_right_corner - ((self.segments_between_corner_points/(slider_value+1)) *i))
-                u_value_lower_right = (self.uValue_right_corner + ((self.segments_between_corner_points/(slider_value+1)) *i)) 
-                u_value_upper_left = (self.uValue_left_corner + ((self.segments_between_corner_points/(slider_value+1)) *i))
-                u_value_lower_left = (self.uValue_left_corner - ((self.segments_between_corner_points/(slider_value+1)) *i))
-            else:
-                u_value_upper_right = (self.uValue_right_corner + ((self.segments_between_corner_points/(slider_value+1)) *i))
-                u_value_lower_right = (self.uValue_right_corner - ((self.segments_between_corner_points/(slider_value+1)) *i)) 
-                u_value_upper_left = (self.uValue_left_corner - ((self.segments_between_corner_points/(slider_value+1)) *i))
-                u_value_lower_left = (self.uValue_left_corner + ((self.segments_between_corner_points/(slider_value+1)) *i))
+        self._segment_joints = {"RU": [], "RD": [], "LU": [], "LD": []}
+        self._current_segment_count = 0
+        self._last_segment_value = None
 
-            segmentJoint_upper_right = set_control_joints(u_value_upper_right, self.v_value, self.lofted_surface, f",{self.prefix}_RU_{i}", self.size)
-            segmentJoint_lower_right = set_control_joints( u_value_lower_right, self.v_value, self.lofted_surface, f",{self.prefix}_RD_{i}", self.size)
-            segmentJoinz_upper_left = set_control_joints( u_value_upper_left, self.v_value, self.lofted_surface , f",{self.prefix}_LU_{i}", self.size)
-            segmentJoint_lower_left = set_control_joints( u_value_lower_left, self.v_value, self.lofted_surface, f",{self.prefix}_LD_{i}", self.size)
-            
-            pm.parent( segmentJoint_upper_right, self.control_joint_grp)
-            pm.parent( segmentJoint_lower_right, self.control_joint_grp)
-            pm.parent( segmentJoinz_upper_left, self.control_joint_grp)
-            pm.parent( segmentJoint_lower_left, self.control_joint_grp)
+    def _check_segment_joints(self):
+
+        if not self._ctrl_grp_exists:
+            return []
+
+        if not cmds.objExists(self.control_joint_grp):
+            self._ctrl_grp_exists = False
+            self._reset_segment_joints()
+            return []
+
+        children = cmds.listRelatives(self.control_joint_grp, children=True) or []
+        tracked = [joint for joints in self._segment_joints.values() for joint in joints]
+        if set(children) != set(tracked):
+            self._reset_segment_joints()
+            return children
+
+        return []
+
+    def segment_joints(self, value):
+
+        stale_joints = self._check_segment_joints()
+        if value == self._last_segment_value and self._ctrl_grp_exists:
+            return
+
+        with rig_build_mode("segment_joints"):
+            self._build_segment_joints(value, stale_joints)
+
+    def _build_segment_joints(self, slider_value, stale_joints):
+
+        if stale_joints:
+            cmds.delete(stale_joints)
+
+        if not self._ctrl_grp_exists:
+            self.control_joint_grp = cmds.group( name= f"{self.prefix}_control_joints_grp", empty = True )
+            self._ctrl_grp_exists = True
+
+        for joints in self._segment_joints.values():
+            if len(joints) > slider_value:
+                cmds.delete(joints[slider_value:])
+                del joints[slider_value:]
+
+        step = self.segments_between_corner_points/(slider_value+1)
+        offsets = [step * i for i in range(1, slider_value+1)]
 
-            pm.select(clear = True)
+        uR = self.uValue_right_corner
+        uL = self.uValue_left_corner
+        corner_u_values = {"RU": uR, "RD": uR, "LU": uL, "LD": uL}
+        directions = self._segment_directions
+        v = self.v_value
+        folShape = self.query_follicle_shape
+        prefix = self.prefix
+        parent = self.control_joint_grp
+        segment_joints = self._segment_joints
+        current_count = self._current_segment_count
+
+        new_keys = []
+        new_specs = []
+        for i, offset in enumerate(offsets, 1) :
+
+            for segment_key, corner_u_value in corner_u_values.items():
+                u_value = corner_u_value + directions[segment_key] * offset
+                if i <= current_count:
+                    place_control_joint(segment_joints[segment_key][i-1], u_value, v, folShape)
+                else:
+                    new_keys.append(segment_key)
+                    new_specs.append((u_value, v, f"{prefix}_{segment_key}_{i}"))
+
+        for segment_key, segment_joint in zip(new_keys, self._make_control_joints(new_specs, parent=parent)):
+            segment_joints[segment_key].append(segment_joint)
+
+        if cmds.ls(selection=True):
+            cmds.select(clear = True)
+
+        self._current_segment_count = slider_value
+        self._last_segment_value = slider_value
+        self._ctrl_joints = [self.right_corner_joint, self.left_corner_joint, self.upper_corner_joint, self.lower_corner_joint]
+        self._ctrl_joints.extend(joints[i] for i in range(slider_value) for joints in self._segment_joints.values())
 
     def finish_rig(self):
 
-        pm.delete(self.curve_1)
-        pm.delete(self.curve_2)
+        self._segment_timer.stop()
+        slider_value = self.inbetween_joints_slider.value()
+        stale_joints = self._check_segment_joints()
+
+        with rig_build_mode("finish_rig"):
+            if slider_value != self._last_segment_value or not self._ctrl_grp_exists:
+                self._build_segment_joints(slider_value, stale_joints)
 
-        if pm.objExists(self.control_joint_grp) == False:
-            self.control_joint_grp = pm.group(  name = f"{self.prefix}_control_ joints_grp", empty = True )
+            cmds.delete(self.curve_1, self.curve_2, self.query_follicle)
 
-        pm.parent(self.right_corner_joint, self.control_joint_grp)
-        pm.parent(self.left_corner_joint, self.control_joint_grp)
-        pm.parent(self.upper_corner_joint, self.control_joint_grp)
-        pm.parent(self.lower_corner_joint, self.control_joint_grp)
+            corner_joints = cmds.parent(self.right_corner_joint, self.left_corner_joint, self.upper_corner_joint, self.lower_corner_joint, self.control_joint_grp)
+            (self.right_corner_joint, self.left_corner_joint,
+             self.upper_corner_joint, self.lower_corner_joint) = corner_joints
+            self._ctrl_joints[:4] = corner_joints
 
-        self.controller_grp = pm.group( name = f"{self.prefix}_controller_grp", empty=True)
+            self.controller_grp = cmds.group( name = f"{self.prefix}_controller_grp", empty=True)
         
-        selJoints = pm.ls('*_ctrl_jnt', flatten = True , recursive = True)
+            selJoints = self._ctrl_joints
 
-        pm.skinCluster(selJoints, self.lofted_surface, bindMethod = 0, toSelectedBones = True, name = f"{self.prefix}_skinCluster")        
+            cmds.skinCluster(selJoints, self.lofted_surface.name(), bindMethod = 0, toSelectedBones = True,
+                             maximumInfluences = 5, dropoffRate = 4, name = f"{self.prefix}_skinCluster")
 
-        for Joints in selJoints:
-           create_controller(Joints, self.controller_grp , self.size)
+            self._controllers_by_segment = {}
+            for segment_key, joint in zip(("R", "L", "U", "D"), corner_joints):
+                self._controllers_by_segment[segment_key] = create_controller(joint, self.controller_grp , self.size)
+            for segment_key, joints in self._segment_joints.items():
+                self._controllers_by_segment[segment_key] = [create_controller(joint, self.controller_grp , self.size) for joint in joints]
             
-        pm.select(clear = True)
+            if cmds.ls(selection=True):
+                cmds.select(clear = True)
 
-        create_blend_for_segment_controller(self.prefix)
+            create_blend_for_segment_controller(self._controllers_by_segment)
 
-        self.binding_joint_grp.v.set(True)
-        self.control_joint_grp.v.set(False)
+            cmds.setAttr(f"{self.binding_joint_grp}.visibility", True)
+            cmds.setAttr(f"{self.control_joint_grp}.visibility", False)
 
     def get_first_edge_loop(self):
 
-        if (pm.ls(selection=True)):
-            self.first_edge_Loop = pm.selected(flatten=True)
-            name = ""
-            for selObj in self.first_edge_Loop:
-                name += selObj.name()
-            
-            self.first_edge_loop_text.setText(str(name))
-            pm.select( clear=True )
+        selection = cmds.ls(selection=True, flatten=False)
+        if selection:
+            self.first_edge_Loop = selection
+            self.first_edge_loop_text.setText(selection_label(self.first_edge_Loop))
+            cmds.select( clear=True )
 
         else:
             print("Please select an edge loop")
 
     def get_2nd_edge_loop(self):
 
-        if (pm.ls(selection=True)):
-            self.second_edge_Loop = pm.selected(flatten=True)
-            name = ""
-            for selObj in self.second_edge_Loop:
-                name += selObj.name()
-            
-            self.second_edge_loop_text.setText(str(name))
-            pm.select( clear=True )
+        selection = cmds.ls(selection=True, flatten=False)
+        if selection:
+            self.second_edge_Loop = selection
+            self.second_edge_loop_text.setText(selection_label(self.second_edge_Loop))
+            cmds.select( clear=True )
         else:
             print("Please select an edge loop")
 
     def get_vertex_on_edge_loop(self):
 
-        if (pm.ls(selection=True)):
-            self.vertex_on_edge = pm.selected(flatten=True)[0]
+        selection = cmds.ls(selection=True, flatten=True)
+        if selection:
+            self.vertex_on_edge = selection[0]
             self.vertex_text.setText(f"{self.vertex_on_edge}")
-            pm.select( clear=True )
+            cmds.select( clear=True )
 
         else:
             print("Please select the vertex")